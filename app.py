@@ -1,43 +1,246 @@
-import streamlit as st, boto3, io, os
-from tempfile import NamedTemporaryFile
+import streamlit as st, boto3, functools, hashlib, json, os, re, threading, time
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from uuid import uuid4
+from xml.sax.saxutils import escape
+
+# Optional offline copy of describe_voices, so the UI can render without
+# calling AWS. Generate it once with credentials and check it in:
+#   python -c "import boto3,json; json.dump(boto3.client('polly').describe_voices()['Voices'], open('voices.json','w'), indent=2)"
+# Without it, or with POLLY_REFRESH_VOICES=1, the live list is fetched.
+VOICES_MANIFEST = os.path.join(os.path.dirname(os.path.abspath(__file__)), "voices.json")
+
+# Parallel Polly requests per Generate. The Polly and S3 clients' connection
+# pools are sized above this so workers never queue waiting for a socket.
+POLLY_CONCURRENCY = 16
+AWS_CONFIG = Config(
+    max_pool_connections=2 * POLLY_CONCURRENCY,
+    tcp_keepalive=True,
+    retries={"mode": "adaptive", "max_attempts": 5},
+    connect_timeout=3,
+    read_timeout=30,
+)
+
+# SynthesizeSpeech accepts at most this many billed characters per request,
+# and at most MAX_REQUEST_CHARS in total once SSML tags are counted
+MAX_CHARS = 3000
+MAX_REQUEST_CHARS = 6000
+
+# A speaker's lines go to Polly as one SSML request, with this pause
+# between bubbles
+LINE_BREAK_MS = 250
+
+# Text longer than this goes through Polly's asynchronous task API (which
+# writes to S3) instead of SynthesizeSpeech, when an output bucket is set.
+POLLY_OUTPUT_BUCKET = os.getenv("POLLY_OUTPUT_BUCKET")
+ASYNC_TASK_CHARS = 2500
+ASYNC_TASK_PREFIX = "polly-tasks/"
+ASYNC_TASK_TIMEOUT_S = 600
+
+# Finished dialogues bigger than this are uploaded to the output bucket and
+# played from a presigned URL instead of being pushed through Streamlit.
+# The URL expires but the object does not: the bucket needs a lifecycle rule
+# expiring DIALOGUES_PREFIX (one day is plenty), e.g.
+#   aws s3api put-bucket-lifecycle-configuration --bucket $POLLY_OUTPUT_BUCKET \
+#     --lifecycle-configuration '{"Rules":[{"ID":"expire-dialogues","Status":"Enabled",
+#       "Filter":{"Prefix":"dialogues/"},"Expiration":{"Days":1}}]}'
+PRESIGN_MIN_BYTES = 2_000_000
+PRESIGN_EXPIRES_S = 3600
+DIALOGUES_PREFIX = "dialogues/"
+
+# Audio is read off the response streams in pieces of this size
+STREAM_CHUNK_BYTES = 8192
+
+# One silent mono 32 kbps MP3 frame per sample rate, with the number of
+# samples it covers. Header only, zeroed side info and main data: decoders
+# play it as silence, and it splices cleanly between Polly's MP3 chunks.
+SILENCE_MP3 = {
+    "22050": (b"\xff\xf3\x40\xc0" + bytes(100), 576),   # MPEG-2 Layer III
+    "48000": (b"\xff\xfb\x14\xc0" + bytes(92), 1152),   # MPEG-1 Layer III
+}
 
 # ── Polly helper ─────────────────────────────────────────────────────
 @st.cache_resource
-def get_polly_and_voices():
-    polly = boto3.client(
+def get_polly():
+    return boto3.client(
         "polly",
+        config=AWS_CONFIG,
         aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
         aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
         region_name=os.getenv("AWS_REGION", "us-east-1")
     )
-    voices = polly.describe_voices()["Voices"]
-    return polly, voices
 
-def synth_line(polly, text, voice, engine, sample_rate):
+@st.cache_resource
+def get_voices():
+    if os.getenv("POLLY_REFRESH_VOICES") != "1" and os.path.exists(VOICES_MANIFEST):
+        with open(VOICES_MANIFEST) as f:
+            return json.load(f)
+
+    return get_polly().describe_voices()["Voices"]
+
+# Opens Polly's HTTPS connection in the background so the first Generate
+# doesn't pay for the TLS handshake. Cached, so it runs once per process.
+@st.cache_resource(show_spinner=False)
+def warm_polly(_polly, voice):
+    def run():
+        try:
+            _polly.synthesize_speech(
+                Text=".", VoiceId=voice, Engine="neural", OutputFormat="pcm",
+            )["AudioStream"].read()
+        except Exception:
+            pass  # even a rejected request leaves the keep-alive connection open
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+def synth_line(polly, text, text_type, voice, engine, sample_rate):
     response = polly.synthesize_speech(
         Text=text,
+        TextType=text_type,
         VoiceId=voice,
         Engine=engine,
         OutputFormat="mp3",
         SampleRate=sample_rate,
     )
-    return response['AudioStream'].read()
+    yield from response['AudioStream'].iter_chunks(STREAM_CHUNK_BYTES)
+
+@st.cache_resource
+def get_s3():
+    return boto3.client(
+        "s3",
+        config=AWS_CONFIG,
+        aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
+        aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+        region_name=os.getenv("AWS_REGION", "us-east-1")
+    )
+
+def synth_line_async_task(polly, s3, text, text_type, voice, engine, sample_rate, bucket):
+    task = polly.start_speech_synthesis_task(
+        Text=text,
+        TextType=text_type,
+        VoiceId=voice,
+        Engine=engine,
+        OutputFormat="mp3",
+        SampleRate=sample_rate,
+        OutputS3BucketName=bucket,
+        OutputS3KeyPrefix=ASYNC_TASK_PREFIX,
+    )["SynthesisTask"]
+
+    # poll with exponential backoff: 0.5s, 1s, 2s, then every 5s
+    delay = 0.5
+    deadline = time.monotonic() + ASYNC_TASK_TIMEOUT_S
+    while task["TaskStatus"] in ("scheduled", "inProgress"):
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Polly task {task['TaskId']} not done after {ASYNC_TASK_TIMEOUT_S}s")
+        time.sleep(delay)
+        delay = min(delay * 2, 5)
+        task = polly.get_speech_synthesis_task(TaskId=task["TaskId"])["SynthesisTask"]
+
+    if task["TaskStatus"] != "completed":
+        raise RuntimeError(task.get("TaskStatusReason", f"task {task['TaskStatus']}"))
+
+    # Polly names its output <OutputS3KeyPrefix><TaskId>.<format>
+    key = f"{ASYNC_TASK_PREFIX}{task['TaskId']}.mp3"
+    try:
+        yield from s3.get_object(Bucket=bucket, Key=key)["Body"].iter_chunks(STREAM_CHUNK_BYTES)
+    finally:
+        # the audio is cached on our side now; don't leave it in the bucket
+        s3.delete_object(Bucket=bucket, Key=key)
+
+SSML_BREAK = f'<break time="{LINE_BREAK_MS}ms"/>'
+
+def to_ssml(lines):
+    return "<speak>" + SSML_BREAK.join(escape(line) for line in lines) + "</speak>"
+
+# Groups bubbles into as few SSML documents as fit one SynthesizeSpeech call
+# each; a single over-long bubble still gets a document of its own
+def ssml_chunks(lines):
+    chunks, current, billed, total = [], [], 0, len("<speak></speak>")
+    for line in lines:
+        text = escape(line)
+        extra = len(text) + (len(SSML_BREAK) if current else 0)
+        if current and (billed + len(text) > MAX_CHARS or total + extra > MAX_REQUEST_CHARS):
+            chunks.append(to_ssml(current))
+            current, billed, total = [], 0, len("<speak></speak>")
+            extra = len(text)
+        current.append(line)
+        billed += len(text)
+        total += extra
+    if current:
+        chunks.append(to_ssml(current))
+    return chunks
+
+def billable_chars(text, text_type):
+    # Polly doesn't bill SSML tags
+    return len(re.sub(r"<[^>]+>", "", text)) if text_type == "ssml" else len(text)
+
+# Keyed on the request's inputs only; the clients come from their cached
+# accessors so they never become part of the key. Kept in memory only:
+# Streamlit's disk persistence ignores max_entries and never evicts.
+@st.cache_data(show_spinner=False, max_entries=1024)
+def synth_cached(text, text_type, voice, engine, sample_rate):
+    polly = get_polly()
+    too_long = billable_chars(text, text_type) > ASYNC_TASK_CHARS or len(text) > MAX_REQUEST_CHARS
+    if POLLY_OUTPUT_BUCKET and too_long:
+        chunks = synth_line_async_task(polly, get_s3(), text, text_type, voice, engine, sample_rate, POLLY_OUTPUT_BUCKET)
+    else:
+        chunks = synth_line(polly, text, text_type, voice, engine, sample_rate)
+    return b"".join(chunks)
+
+# The pause slider moves in 100 ms steps, so only a few dozen distinct
+# silences are ever built; keep them around
+@functools.lru_cache(maxsize=64)
+def silence_mp3(ms, sample_rate):
+    frame, samples = SILENCE_MP3[sample_rate]
+    return frame * round(ms * int(sample_rate) / 1000 / samples)
+
+# The voice list comes from the cached voices resource and is fixed for the
+# life of the process, so it is left out of the keys (leading underscore).
+@st.cache_data(show_spinner=False)
+def list_languages(_all_voices):
+    return sorted({v["LanguageCode"] for v in _all_voices})
+
+@st.cache_data(show_spinner=False)
+def filter_voices(_all_voices, language, engine):
+    return sorted(
+        v["Name"] for v in _all_voices
+        if v["LanguageCode"] == language and engine in v["SupportedEngines"]
+    )
+
+# Split + strip of a speaker's text, kept per speaker in the session and
+# recomputed only when that speaker's text actually changes
+def speaker_lines(sp):
+    cache = st.session_state.setdefault("_lines_cache", {})
+    digest = hashlib.md5(sp["lines"].encode()).digest()
+    entry = cache.get(id(sp))
+    if entry is None or entry["hash"] != digest:
+        entry = cache[id(sp)] = {
+            "hash": digest,
+            "nonempty": [line for raw in sp["lines"].splitlines() if (line := raw.strip())],
+            "nchars": len(sp["lines"].strip()),
+        }
+    return entry
 
 # ── App UI ───────────────────────────────────────────────────────────
 st.title("🗣️ Polly Dialogue Builder")
 
 try:
-    polly, all_voices = get_polly_and_voices()
+    all_voices = get_voices()
+    polly = get_polly()
 except Exception as e:
     st.error(f"Could not reach Polly → {e}")
     st.stop()
 
+warm_polly(polly, next((v["Name"] for v in all_voices if "neural" in v["SupportedEngines"]), None))
+
 # Global Settings
 st.sidebar.header("Global Voice Settings")
 voice_quality = st.sidebar.selectbox("Voice Quality", options=["generative", "neural"])
 sample_rate = st.sidebar.selectbox("Sample Rate", options=["22050", "48000"])
 
-languages = sorted(set(v["LanguageCode"] for v in all_voices))
+languages = list_languages(all_voices)
 selected_language = st.sidebar.selectbox(
     "Language",
     languages,
@@ -45,10 +248,8 @@ selected_language = st.sidebar.selectbox(
 )
 
 # Filter voices by language and engine
-VOICES = sorted([
-    v["Name"] for v in all_voices
-    if selected_language == v["LanguageCode"] and voice_quality in v["SupportedEngines"]
-])
+VOICES = filter_voices(all_voices, selected_language, voice_quality)
+VOICE_INDEX = {name: i for i, name in enumerate(VOICES)}
 
 if not VOICES:
     st.error("No voices available for that language + quality. Try changing options.")
@@ -62,24 +263,28 @@ if "speakers" not in st.session_state:
     ]
 
 # Speaker configuration
-del_idx = None
-for i, sp in enumerate(st.session_state.speakers):
-    with st.expander(f"Speaker {i+1}", expanded=True):
-        if sp["voice"] not in VOICES:
-            sp["voice"] = VOICES[0]
+# Each speaker is a fragment holding its own form: typing and sliding don't
+# rerun anything until "Apply changes", and applying only reruns that
+# speaker's expander, not the whole script.
+@st.fragment
+def render_speaker(i, sp, voices, voice_index):
+    with st.expander(f"Speaker {i+1}", expanded=True), st.form(f"speaker_{i}"):
+        if sp["voice"] not in voice_index:
+            sp["voice"] = voices[0]
 
         sp["voice"] = st.selectbox(
-            "Voice", VOICES,
-            index=VOICES.index(sp["voice"]),
+            "Voice", voices,
+            index=voice_index[sp["voice"]],
             key=f"voice_{i}",
         )
 
-        MAX_CHARS = 3000
         lines = st.text_area(
             "Lines (one per bubble)", sp["lines"],
             key=f"lines_{i}", height=120,
         )
-        char_count = len(lines.strip())
+        sp["lines"] = lines
+
+        char_count = speaker_lines(sp)["nchars"]
         remaining = MAX_CHARS - char_count
         char_text = f"🧮 {remaining} characters left"
 
@@ -88,18 +293,27 @@ for i, sp in enumerate(st.session_state.speakers):
         else:
             st.caption(char_text)
 
-        sp["lines"] = lines
-
         sp["pause"] = st.slider(
             "Pause AFTER this speaker (ms)",
             0, 3000, sp["pause"], 100, key=f"pause_{i}",
         )
 
-        if st.button("Remove speaker", key=f"del_{i}"):
-            del_idx = i
+        st.form_submit_button("Apply changes")
+
+for i, sp in enumerate(st.session_state.speakers):
+    render_speaker(i, sp, VOICES, VOICE_INDEX)
+
+# Removing a speaker needs a full rerun, so these buttons stay outside the
+# fragments and their forms
+del_idx = None
+cols = st.columns(min(len(st.session_state.speakers), 5) or 1)
+for i in range(len(st.session_state.speakers)):
+    if cols[i % len(cols)].button(f"Remove speaker {i+1}", key=f"del_{i}"):
+        del_idx = i
 
 if del_idx is not None:
-    st.session_state.speakers.pop(del_idx)
+    removed = st.session_state.speakers.pop(del_idx)
+    st.session_state.get("_lines_cache", {}).pop(id(removed), None)
     st.rerun()
 
 if len(st.session_state.speakers) < 20 and st.button("➕ Add speaker"):
@@ -111,33 +325,86 @@ if len(st.session_state.speakers) < 20 and st.button("➕ Add speaker"):
 
 # ── Generate button ────────────────────────────────────────────────
 if st.button("Generate ▶️", type="primary"):
-    audio_chunks = []
-
+    # plan the output as audio and silence steps; each distinct
+    # (text, type, voice, engine, rate) is sent to Polly only once.
+    # A speaker's bubbles share SSML requests, so the cache and the de-dup
+    # work per SSML chunk: editing any bubble re-synthesises its whole chunk,
+    # and a repeated "Yes." is only shared between chunks that match entirely.
+    tasks, plan = {}, []
     for sp in st.session_state.speakers:
-        for line in sp["lines"].splitlines():
-            if line := line.strip():
-                try:
-                    audio_chunks.append(synth_line(polly, line, sp["voice"], voice_quality, sample_rate))
-                except Exception as e:
-                    st.error(f"Polly error with voice “{sp['voice']}” → {e}")
-                    st.stop()
+        lines = speaker_lines(sp)["nonempty"]
+        if not lines:
+            requests = []
+        elif POLLY_OUTPUT_BUCKET:
+            # the task API takes the whole block, however long
+            requests = [to_ssml(lines)]
+        else:
+            requests = ssml_chunks(lines)
+
+        for n, text in enumerate(requests):
+            if n:
+                # same gap between chunks as the <break/> inside them
+                plan.append(("silence", LINE_BREAK_MS))
+            key = (text, "ssml", sp["voice"], voice_quality, sample_rate)
+            tasks[key] = None
+            plan.append(("audio", key))
         if sp["pause"]:
-            # generate silent MP3 bytes (1 sec = 22050 bytes @ ~22kbps)
-            silence_ms = sp["pause"]
-            silence_bytes = b'\0' * int(22050 * (silence_ms / 1000))
-            audio_chunks.append(silence_bytes)
+            plan.append(("silence", sp["pause"]))
 
-    if not audio_chunks:
-        st.warning("No dialogue to synthesise.")
-    else:
-        with NamedTemporaryFile(delete=False, suffix=".mp3") as tmp:
-            for chunk in audio_chunks:
-                tmp.write(chunk)
-            tmp.seek(0)
-            st.audio(tmp.name, format="audio/mp3")
+    # boto3 clients are thread-safe, so the workers share the one Polly client
+    # and its keep-alive connection pool; no more threads than requests.
+    # Workers carry this session's script context so the caches work there.
+    with ThreadPoolExecutor(
+        max_workers=max(1, min(POLLY_CONCURRENCY, len(tasks))),
+        initializer=add_script_run_ctx, initargs=(None, get_script_run_ctx()),
+    ) as pool:
+        futures = {key: pool.submit(synth_cached, *key) for key in tasks}
+        for key, future in futures.items():
+            if err := future.exception():
+                st.error(f"Polly error with voice “{key[2]}” → {err}")
+                pool.shutdown(cancel_futures=True)
+                st.stop()
+            tasks[key] = future.result()
 
-            # Read and pass bytes to download button
-            with open(tmp.name, "rb") as f:
-                mp3_bytes = f.read()
-            st.download_button("💾 Download MP3", mp3_bytes, file_name="dialogue.mp3", mime="audio/mpeg")
+    # write every chunk straight into one buffer, no list of parts to join
+    out = bytearray()
+    for kind, value in plan:
+        out.extend(tasks[value] if kind == "audio" else silence_mp3(value, sample_rate))
 
+    if not out:
+        st.warning("No dialogue to synthesise.")
+    elif POLLY_OUTPUT_BUCKET and len(out) > PRESIGN_MIN_BYTES:
+        # let the browser fetch large files straight from S3
+        s3 = get_s3()
+        key = f"{DIALOGUES_PREFIX}{uuid4()}.mp3"
+        try:
+            s3.put_object(Bucket=POLLY_OUTPUT_BUCKET, Key=key, Body=out, ContentType="audio/mpeg")
+            url = s3.generate_presigned_url(
+                "get_object",
+                Params={"Bucket": POLLY_OUTPUT_BUCKET, "Key": key},
+                ExpiresIn=PRESIGN_EXPIRES_S,
+            )
+            # same object, but served as an attachment so the link downloads
+            # instead of opening the player in a new tab
+            download_url = s3.generate_presigned_url(
+                "get_object",
+                Params={
+                    "Bucket": POLLY_OUTPUT_BUCKET,
+                    "Key": key,
+                    "ResponseContentDisposition": 'attachment; filename="dialogue.mp3"',
+                },
+                ExpiresIn=PRESIGN_EXPIRES_S,
+            )
+        except Exception as e:
+            st.error(f"Could not upload to S3 bucket “{POLLY_OUTPUT_BUCKET}” → {e}")
+            st.stop()
+        st.audio(url, format="audio/mpeg")
+        st.link_button("💾 Download MP3", download_url)
+    else:
+        # Streamlit keeps its own copy of media it serves, so hand the player
+        # and the download button the same bytes object instead of
+        # round-tripping through a temp file and reading it back.
+        mp3_bytes = bytes(out)
+        del out
+        st.audio(mp3_bytes, format="audio/mpeg")
+        st.download_button("💾 Download MP3", mp3_bytes, file_name="dialogue.mp3", mime="audio/mpeg")